@@ -1,5 +1,17 @@
+import hashlib
+import inspect
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Value
+from io import BytesIO
+from itertools import repeat
+from typing import Dict, Optional, Tuple
+
 import cadquery as cq
-from cadquery import exporters
+from OCP.OSD import OSD_ThreadPool
+from OCP.StlAPI import StlAPI_Writer
+import opk
 from opk import make_keycap
 
 keys = {
@@ -71,9 +83,77 @@ rows = [
 ]
 
 
-def export_keys(key_rows=rows, export=False, export_assy=False, tol:float=0.0005, angular_tol:float=0.05):
+def write_stl(shape: cq.Shape, path: str, tol: float, angular_tol: float):
+    """
+    Mesh the shape and write it as binary STL.
+    """
+    shape.mesh(tol, angular_tol)
+    writer = StlAPI_Writer()
+    # binary STL, ASCII is several times larger and slower to format
+    writer.ASCIIMode = False
+    if not writer.Write(shape.wrapped, path):
+        raise IOError("failed to write " + path)
+
+
+def _init_worker(counter):
+    """
+    Pin each worker to its own core and cap OCCT's thread pool, otherwise
+    every worker starts one OCCT thread per core and they fight for the CPUs.
+    """
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+
+    OSD_ThreadPool.DefaultPool_s().Init(1)
+
+
+def _cache_path(cache_dir: str, params: dict) -> str:
+    """
+    BREP cache file of a keycap. The key covers the parameters and the opk
+    source, editing the profile code invalidates the old entries.
+    """
+    digest = hashlib.blake2b(repr(sorted(params.items())).encode())
+    digest.update(inspect.getsource(opk).encode())
+    return os.path.join(cache_dir, digest.hexdigest()[:16] + ".brep")
+
+
+def _build_and_export(name: str, params: dict, export: bool, tol: float, angular_tol: float, cache_dir: Optional[str]) -> Tuple[bytes, bool]:
+    """
+    Build one keycap in a worker process and optionally export its STL.
+    The shape is returned as BREP so it can be shipped back for the assembly,
+    along with whether it was loaded from cache_dir instead of rebuilt.
+    """
+    path = _cache_path(cache_dir, params) if cache_dir else None
+    cached = bool(path) and os.path.exists(path)
+    if cached:
+        cap = cq.Shape.importBrep(path)
+    else:
+        cap = make_keycap(**params).val()
+        if path:
+            # write aside and rename, an interrupted run can't leave a broken entry
+            os.makedirs(cache_dir, exist_ok=True)
+            cap.exportBrep(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    # serialize before meshing, the triangulation isn't needed by the parent
+    brep = BytesIO()
+    cap.exportBrep(brep)
+
+    if export:
+        # cap.exportStep("./export/STEP/" + name + ".step")
+        write_stl(cap, "./export/STL/" + name + ".stl", tol, angular_tol)
+
+    return brep.getvalue(), cached
+
+
+def export_keys(key_rows=rows, export=False, export_assy=False, tol:float=0.0005, angular_tol:float=0.05, workers:Optional[int]=None, tol_scale:bool=False, cache_dir:Optional[str]=None):
     assy = cq.Assembly()
 
+    tasks = []
     y = 0
     for i, r in enumerate(key_rows):
         x = 0
@@ -90,8 +170,7 @@ def export_keys(key_rows=rows, export=False, export_assy=False, tol:float=0.0005
                     name += "_homing"
                 depth = k["depth"]
 
-            print("Generating: ", name)
-            cap = make_keycap(
+            params = dict(
                 angle=r["angle"],
                 height=r["height"],
                 unit_x=k["unit_x"],
@@ -99,42 +178,85 @@ def export_keys(key_rows=rows, export=False, export_assy=False, tol:float=0.0005
                 depth=depth,
                 stem_type="alps"
             )
-            # Export one key at the time
-
-            if export:
-                # exporters.export(
-                #     cap,
-                #     "./export/STEP/" + name + ".step",
-                #     tolerance=tol,
-                #     angularTolerance=angular_tol
-                # )
-                exporters.export(
-                    cap,
-                    "./export/STL/" + name + ".stl",
-                    tolerance=tol,
-                    angularTolerance=angular_tol
-                )
+            # Meshing is relative, chord error already grows with the edges.
+            # tol_scale coarsens wide caps further, trading accuracy for speed
+            key_tol = tol * max(1.0, k["unit_x"]) if tol_scale else tol
+
             w = 19.05 * k["unit_x"] / 2
             x += w
-            assy.add(cap, name=name, loc=cq.Location(cq.Vector(x, y, 0)))
+            tasks.append((name, params, key_tol, cq.Location(cq.Vector(x, y, 0))))
             x += w
         y -= 19.05
 
+    # Identical keys are built once, the assembly places the same shape
+    # several times at different locations
+    builds = {}
+    for name, params, key_tol, loc in tasks:
+        builds.setdefault(tuple(params.values()), (name, params, key_tol))
+
+    # Every key is an independent OCCT job, build and export them in parallel
+    names, build_params, tols = zip(*builds.values()) if builds else ((), (), ())
+
+    if not workers:
+        if hasattr(os, "sched_getaffinity"):
+            workers = len(os.sched_getaffinity(0))
+        else:
+            workers = os.cpu_count()
+
+    # Parallelism comes from the pool, keep native thread pools single
+    # threaded. The workers inherit the variables, the caller's are restored
+    thread_vars = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+    saved_env = {var: os.environ.get(var) for var in thread_vars}
+    for var in thread_vars:
+        os.environ.setdefault(var, "1")
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(Value("i", 0),),
+        ) as pool:
+            results = pool.map(_build_and_export, names, build_params, repeat(export), tols, repeat(angular_tol), repeat(cache_dir))
+
+            # report from the parent, workers printing at once interleave their output
+            breps = []
+            for name, (brep, cached) in zip(names, results):
+                print("Loaded: " if cached else "Generated: ", name)
+                breps.append(brep)
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    canonical: Dict[tuple, cq.Shape] = {
+        key: cq.Shape.importBrep(BytesIO(brep)) for key, brep in zip(builds, breps)
+    }
+
+    placed_shapes = []
+    for name, params, _, loc in tasks:
+        key = tuple(params.values())
+        cap = canonical[key]
+        if export and name != builds[key][0]:
+            # same geometry as an exported key, reuse its file
+            shutil.copyfile(
+                "./export/STL/" + builds[key][0] + ".stl", "./export/STL/" + name + ".stl"
+            )
+        assy.add(cap, name=name, loc=loc)
+        placed_shapes.append(cap.moved(loc))
+
     if "show_object" in locals():
         show_object(assy)
 
     if export_assy:
-        exporters.export(
-            assy.toCompound(), "./export/opk_keycaps_all.stl", tolerance=tol, angularTolerance=angular_tol
-        )
-        exporters.export(
-            assy.toCompound(),
-            "./export/opk_keycaps_all.step",
-            tolerance=tol,
-            angularTolerance=angular_tol,
-        )
+        # Build the compound once from the placed shapes, without walking the
+        # assembly tree, both files are written from the same shape
+        compound = cq.Compound.makeCompound(placed_shapes)
+        write_stl(compound, "./export/opk_keycaps_all.stl", tol, angular_tol)
+        compound.exportStep("./export/opk_keycaps_all.step")
 
     return assy
 
 if __name__ == "__main__":
-    export_keys(rows, export=True, export_assy=True)
+    export_keys(rows, export=True, export_assy=True, cache_dir=".cache")
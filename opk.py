@@ -25,7 +25,10 @@ https://matt3o.com
 """
 
 import math
+import numpy as np
 import cadquery as cq
+from OCP.BOPAlgo import BOPAlgo_Builder
+from functools import lru_cache, wraps
 from typing import List, Optional, Tuple, Union
 
 unit_x: float = 2  # keycap size in unit. Standard sizes: 1, 1.25, 1.5, ...
@@ -42,6 +45,48 @@ thickness: float = 1.5  # Keycap sides thickness
 convex: bool = True  # Is this a spacebar?
 pos: bool = False  # use POS style stabilizers
 
+_caches = []  # memoized builders, emptied by clear_caches()
+
+
+def quantize(value):
+    """
+    normalizes arguments into hashable cache keys, rounding floats
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(quantize(v) for v in value)
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def shape_cache(func):
+    """
+    memoizes a Workplane builder on its quantized arguments. Only the
+    underlying shape is cached, every call gets a fresh Workplane around it
+    """
+
+    @lru_cache(maxsize=None)
+    def build(*args, **kwargs) -> cq.Shape:
+        return func(*args, **kwargs).val()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs) -> cq.Workplane:
+        shape = build(
+            *quantize(args), **{k: quantize(v) for k, v in kwargs.items()}
+        )
+        return cq.Workplane("XY").add(shape)
+
+    _caches.append(build)
+    return wrapper
+
+
+def clear_caches():
+    """
+    drops every memoized shape, e.g. after changing the module parameters
+    """
+    for cache in _caches:
+        cache.cache_clear()
+
 
 def calc_base_dim(unit_x, unit_y, base_dim):
     """
@@ -62,10 +107,22 @@ def calc_top_dim(base_dims, top_dim):
     return [x - diff for x in base_dims]
 
 
-def rounded_rect(w: float, h: float, radius: float) -> cq.Sketch:
+@lru_cache(maxsize=256)
+def _rounded_rect(w: float, h: float, radius: float) -> cq.Sketch:
     return cq.Sketch().rect(w, h).vertices().fillet(radius)
 
 
+_caches.append(_rounded_rect)
+
+
+def rounded_rect(w: float, h: float, radius: float) -> cq.Sketch:
+    """
+    cached sketch, callers only place it with `moved`/`placeSketch` which copy
+    """
+    return _rounded_rect(*quantize((w, h, radius)))
+
+
+@shape_cache
 def make_keycap_shell(
     base_dims: List[float],
     b_fillet: float,
@@ -98,9 +155,20 @@ def saddle(x:float, w:float=1, h:float=1, steepness:int=1, convex:int=-1):
         raise ValueError("steepness should be integers > 0")
 
     steepness *= 2
-    return x, -convex * math.atan((x / w) ** steepness) * h / 1.55
+    return x, -convex * np.arctan((x / w) ** steepness) * h / 1.55
+
+
+def saddle_edge(plane: cq.Plane, start: float, stop: float, N: int = 400, **kwargs) -> cq.Edge:
+    """
+    samples the saddle over a whole numpy array at once and fits a spline
+    through the points, same result as parametricCurve without the callbacks
+    """
+    xs, ys = saddle(np.linspace(start, stop, N + 1), **kwargs)
+    pts = [plane.toWorldCoords((x, y)) for x, y in zip(xs.tolist(), ys.tolist())]
+    return cq.Edge.makeSplineApprox(pts, tol=1e-6, smoothing=(1, 8, 3))
 
 
+@shape_cache
 def make_scoop(base_x, base_y, height, depth, angle, convex=False) -> cq.Workplane:
     """
     Create a body that will be carved from the main shape to create the top scoop
@@ -120,44 +188,54 @@ def make_scoop(base_x, base_y, height, depth, angle, convex=False) -> cq.Workpla
             .extrude(base_x, combine=False)
         )
     else:
-        scoop = (
+        sections = _make_scoop_sections(base_x, base_y, height, depth, angle)
+        scoop = cq.Workplane("YZ").add(cq.Solid.makeLoft(sections))
+    return scoop
+
+
+def _make_scoop_sections(base_x, base_y, height, depth, angle) -> List[cq.Wire]:
+    """
+    Create the three cross sections (side, middle, side) lofted into the
+    concave scoop
+    """
+    side = [(-base_y / 2 + 2, 0), (0, min(-0.1, -depth + 1.5)), (base_y / 2 - 2, 0)]
+    middle = [(-base_y / 2 - 2, -0.5), (0, -depth), (base_y / 2 + 2, -0.5)]
+
+    sections = []
+    for i, (start, mid, end) in enumerate([side, middle, side]):
+        section = (
             cq.Workplane("YZ")
             .transformed(
                 offset=cq.Vector(0, height, base_x / 2), rotate=cq.Vector(0, 0, angle)
             )
-            .moveTo(-base_y / 2 + 2, 0)
-            .threePointArc((0, min(-0.1, -depth + 1.5)), (base_y / 2 - 2, 0))
-            .lineTo(base_y / 2, height)
-            .lineTo(-base_y / 2, height)
-            .close()
-            .workplane(offset=-base_x / 2)
-            .moveTo(-base_y / 2 - 2, -0.5)
-            .threePointArc((0, -depth), (base_y / 2 + 2, -0.5))
-            .lineTo(base_y / 2, height)
-            .lineTo(-base_y / 2, height)
-            .close()
-            .workplane(offset=-base_x / 2)
-            .moveTo(-base_y / 2 + 2, 0)
-            .threePointArc((0, min(-0.1, -depth + 1.5)), (base_y / 2 - 2, 0))
+            .workplane(offset=-i * base_x / 2)
+            .moveTo(*start)
+            .threePointArc(mid, end)
             .lineTo(base_y / 2, height)
             .lineTo(-base_y / 2, height)
             .close()
-            .loft(combine=False)
         )
-    return scoop
+        sections.append(section.val())
+
+    return sections
 
 
-def make_noodle_scoop(top_x:float, top_y:float, translate_z:float) -> cq.Workplane:
-    yz_wire = (
-        cq.Workplane("YZ")
-        .transformed(offset=(0,-2))
-        .parametricCurve(lambda x: saddle(x, w=top_y, h=height,steepness=4, convex=1), start=-top_y, stop=top_y) 
+@shape_cache
+def make_noodle_scoop(top_x:float, top_y:float, translate_z:float, height:float) -> cq.Workplane:
+    yz_plane = cq.Workplane("YZ").transformed(offset=(0,-2)).plane
+    yz_wire = cq.Wire.assembleEdges(
+        [saddle_edge(yz_plane, -top_y, top_y, w=top_y, h=height, steepness=4, convex=1)]
+    )
+
+    profile = saddle_edge(cq.Plane.named("XZ"), -top_x, top_y, w=top_x, h=height, steepness=2)
+    profile_wire = cq.Wire.assembleEdges(
+        [profile, cq.Edge.makeLine(profile.endPoint(), profile.startPoint())]
     )
 
     scoop = (
         cq.Workplane("XZ")
-        .parametricCurve(lambda x: saddle(x, w=top_x, h=height,steepness=2), start=-top_x, stop=top_y, makeWire=False)
-        .close()
+        .add(profile_wire)
+        .toPending()
         .sweep(yz_wire)
         .translate((0, 0, translate_z))
     )
@@ -165,7 +243,8 @@ def make_noodle_scoop(top_x:float, top_y:float, translate_z:float) -> cq.Workpla
     return scoop
 
 
-def calc_stem_points(unit_x, unit_y, pos=False) -> List[float]:
+@lru_cache(maxsize=128)
+def calc_stem_points(unit_x, unit_y, pos=False) -> Tuple[Tuple[float, float], ...]:
     """
     finds the locations of stems
     """
@@ -200,7 +279,10 @@ def calc_stem_points(unit_x, unit_y, pos=False) -> List[float]:
 
     stem_pts.sort(key=lambda x: sum(x))
 
-    return stem_pts
+    return tuple(stem_pts)
+
+
+_caches.append(calc_stem_points)
 
 
 def make_cherry_stem() -> cq.Workplane:
@@ -213,8 +295,19 @@ def make_cherry_stem() -> cq.Workplane:
     cross_horiz = [4.15, 1.27]
     cross_vert = [1.12, 4.15]
     rib_z = 4.5
+    chamfer = 0.2
 
+    # the tip chamfers are lofts between a chamfer-sized offset sketch and
+    # the full one, cheaper and sturdier than BRep chamfers
+    tip_sketch = cq.Sketch().circle(stem_dia - chamfer)
+    body_sketch = cq.Sketch().circle(stem_dia)
     cross_sketch = cq.Sketch().rect(*cross_horiz).rect(*cross_vert).clean()
+    lead_in_sketch = (
+        cq.Sketch()
+        .rect(*[d + 2 * chamfer for d in cross_horiz])
+        .rect(*[d + 2 * chamfer for d in cross_vert])
+        .clean()
+    )
     rib_sketch = (
         cq.Sketch()
         .circle(stem_dia)
@@ -225,8 +318,12 @@ def make_cherry_stem() -> cq.Workplane:
 
     return (
         cq.Workplane()
-        .circle(stem_dia)
-        .extrude(rib_z - stem_z_inset)
+        .placeSketch(tip_sketch, body_sketch.moved(cq.Location(cq.Vector(0, 0, chamfer))))
+        .loft()
+        .faces(">Z")
+        .workplane()
+        .placeSketch(body_sketch)
+        .extrude(rib_z - stem_z_inset - chamfer)
         .faces(">Z")
         .workplane()
         .placeSketch(rib_sketch)
@@ -236,8 +333,9 @@ def make_cherry_stem() -> cq.Workplane:
         .placeSketch(cross_sketch)
         .extrude(-4.6, combine="cut")
         .faces("<Z")
-        .edges()
-        .chamfer(0.2)
+        .workplane()
+        .placeSketch(lead_in_sketch, cross_sketch.moved(cq.Location(cq.Vector(0, 0, -chamfer))))
+        .loft(combine="cut")
         .translate([0, 0, stem_z_inset])
     )
 
@@ -247,20 +345,35 @@ def make_alps_stem() -> cq.Workplane:
     makes a single alps stem with supporting ribs
     """
     alps_stem_dims = [4.35, 2.1]
+    wall = 0.7
     rib_thickness = 0.8
     rib_z = 5.4
+    chamfer = 0.2
 
+    # chamfered sketches and a loft for the tip replace the BRep chamfers,
+    # the slot is cut afterwards so the loft doesn't narrow it
+    body_sketch = cq.Sketch().rect(*alps_stem_dims).vertices().chamfer(chamfer)
+    tip_sketch = (
+        cq.Sketch()
+        .rect(*[d - 2 * chamfer for d in alps_stem_dims])
+        .vertices()
+        .chamfer(chamfer)
+    )
+    slot_sketch = cq.Sketch().rect(*[d - 2 * wall for d in alps_stem_dims])
     rib_sketch = cq.Sketch().rect(100, rib_thickness).rect(rib_thickness, 100).clean()
 
     return (
         cq.Workplane()
-        .rect(*alps_stem_dims)
-        .extrude(20)
+        .placeSketch(tip_sketch, body_sketch.moved(cq.Location(cq.Vector(0, 0, chamfer))))
+        .loft()
+        .faces(">Z")
+        .workplane()
+        .placeSketch(body_sketch)
+        .extrude(20 - chamfer)
         .faces("<Z")
-        .shell(-0.7)
-        .faces(">X or <X or >Y or <Y")
-        .edges()
-        .chamfer(0.2)
+        .workplane()
+        .placeSketch(slot_sketch)
+        .extrude(-(20 - wall), combine="cut")
         .faces("<Z")
         .workplane()
         .transformed(offset=[0, 0, -rib_z])
@@ -269,24 +382,51 @@ def make_alps_stem() -> cq.Workplane:
     )
 
 
+@lru_cache(maxsize=None)
+def cached_stem(type: str = "cherry") -> cq.Shape:
+    """
+    builds a single stem once, copies are placed with `moved`
+    """
+    if type == "alps":
+        return make_alps_stem().val()
+    return make_cherry_stem().val()
+
+
+_caches.append(cached_stem)
+
+
 def make_stems(unit_x: float, unit_y: float, pos: bool, type="cherry"):
     """
     make multiple stems based on keysize
-    """    
+    """
     stem_pts = calc_stem_points(unit_x, unit_y, pos)
 
     if type not in ["cherry", "alps"]:
         raise TypeError('stem type must be one of ["cherry", "alps"]')
 
-    stems = cq.Workplane()
+    stem_shapes = []
     for pt in stem_pts:
         if pt == (0, 0) and type == "alps":
-            stem = make_alps_stem().translate(pt)
+            stem = cached_stem("alps")
         else:
-            stem = make_cherry_stem().translate(pt)
-        stems = stems.union(stem)
+            stem = cached_stem("cherry")
+        stem_shapes.append(stem.moved(cq.Location(cq.Vector(*pt, 0))))
+
+    if len(stem_shapes) == 1:
+        return cq.Workplane("XY").add(stem_shapes[0])
+
+    # the ribs of neighbouring stems overlap, split them all against each
+    # other in one general fuse. It only runs in parallel when OCCT has
+    # threads to spare, export_keys workers are capped to one
+    builder = BOPAlgo_Builder()
+    for stem in stem_shapes:
+        builder.AddArgument(stem.wrapped)
+    builder.SetRunParallel(True)
+    builder.Perform()
+    if builder.HasErrors():
+        raise RuntimeError("failed to fuse the stems")
 
-    return stems
+    return cq.Workplane("XY").add(cq.Shape.cast(builder.Shape()))
 
 
 def make_keycap(
@@ -324,14 +464,17 @@ def make_keycap(
         .edges()
     )
 
+    # step the radius down until OCCT accepts it, give up below 0.1
     filleted = False
     surface_fillet = s_fillet
     while not filleted:
         try:
             outer_shell = outer_shell.fillet(surface_fillet)
             filleted = True
-        except:
-            surface_fillet -= 0.1
+        except Exception:
+            surface_fillet = round(surface_fillet - 0.1, 6)
+            if surface_fillet < 0.1:
+                raise
 
     stems = make_stems(unit_x, unit_y, pos, type=stem_type).intersect(outer_shell)
     keycap = outer_shell - inner_shell + stems
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+
+cq = pytest.importorskip("cadquery")
+
+import generate_exports
+
+PARAMS = dict(angle=8, height=9.75, unit_x=1, convex=False, depth=2.8, stem_type="alps")
+
+
+@pytest.fixture
+def stub_keycap(monkeypatch):
+    """
+    replaces make_keycap with a cheap box and records the calls
+    """
+    calls = []
+
+    def make_keycap(**params):
+        calls.append(params)
+        return cq.Workplane("XY").box(10, 10, params["height"])
+
+    monkeypatch.setattr(generate_exports, "make_keycap", make_keycap)
+    return calls
+
+
+def test_cache_path_tracks_params_and_source(tmp_path, monkeypatch):
+    path = generate_exports._cache_path(str(tmp_path), PARAMS)
+    assert path == generate_exports._cache_path(str(tmp_path), dict(PARAMS))
+    assert path != generate_exports._cache_path(str(tmp_path), dict(PARAMS, unit_x=1.25))
+
+    monkeypatch.setattr(generate_exports.inspect, "getsource", lambda module: "# edited")
+    assert path != generate_exports._cache_path(str(tmp_path), PARAMS)
+
+
+def test_build_uses_cache(tmp_path, stub_keycap):
+    cache_dir = tmp_path / "cache"
+
+    _, cached = generate_exports._build_and_export("key", PARAMS, False, 0.01, 0.5, str(cache_dir))
+    assert not cached
+    assert len(stub_keycap) == 1
+    # the temporary file was renamed into place
+    assert [p.suffix for p in cache_dir.iterdir()] == [".brep"]
+
+    brep, cached = generate_exports._build_and_export("key", PARAMS, False, 0.01, 0.5, str(cache_dir))
+    assert cached
+    assert len(stub_keycap) == 1
+    assert cq.Shape.importBrep(BytesIO(brep)).Volume() == pytest.approx(10 * 10 * 9.75)
+
+
+def test_build_without_cache(tmp_path, stub_keycap):
+    for _ in range(2):
+        _, cached = generate_exports._build_and_export("key", PARAMS, False, 0.01, 0.5, None)
+        assert not cached
+    assert len(stub_keycap) == 2
+
+
+def test_identical_keys_built_once(tmp_path, monkeypatch, stub_keycap):
+    # run the jobs in threads so the stubbed make_keycap is used
+    monkeypatch.setattr(generate_exports, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(generate_exports, "_init_worker", lambda counter: None)
+    monkeypatch.chdir(tmp_path)
+    stl = tmp_path / "export" / "STL"
+    stl.mkdir(parents=True)
+
+    row = {"angle": 8, "height": 9.75, "keys": [{"unit_x": 1}]}
+    assy = generate_exports.export_keys([row, row], export=True, tol=0.01, angular_tol=0.5)
+
+    assert len(stub_keycap) == 1
+    assert (stl / "row0_U1.stl").read_bytes() == (stl / "row1_U1.stl").read_bytes()
+    assert [child.name for child in assy.children] == ["row0_U1", "row1_U1"]
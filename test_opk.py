@@ -0,0 +1,34 @@
+import pytest
+
+cq = pytest.importorskip("cadquery")
+
+import opk
+
+
+def fused_stems(unit_x, unit_y, pos, type="cherry"):
+    """
+    stems joined with a single multi-tool fuse, the previous make_stems
+    """
+    stems = []
+    for pt in opk.calc_stem_points(unit_x, unit_y, pos):
+        stem = opk.cached_stem("alps" if pt == (0, 0) and type == "alps" else "cherry")
+        stems.append(stem.moved(cq.Location(cq.Vector(*pt, 0))))
+    return cq.Workplane("XY").add(stems[0].fuse(*stems[1:]))
+
+
+@pytest.mark.parametrize("stem_type", ["cherry", "alps"])
+def test_single_stem_keycap(stem_type):
+    cap = opk.make_keycap(unit_x=1, convex=False, stem_type=stem_type)
+    assert cap.val().isValid()
+    assert cap.val().Volume() > 0
+
+
+@pytest.mark.parametrize("unit_x, convex", [(2.25, False), (3, True)])
+def test_stabilized_keycap(unit_x, convex, monkeypatch):
+    cap = opk.make_keycap(unit_x=unit_x, convex=convex, stem_type="alps")
+    assert cap.val().isValid()
+    assert len(cap.solids().vals()) == 1
+
+    monkeypatch.setattr(opk, "make_stems", fused_stems)
+    expected = opk.make_keycap(unit_x=unit_x, convex=convex, stem_type="alps")
+    assert cap.val().Volume() == pytest.approx(expected.val().Volume(), rel=1e-6)